@@ -1,58 +1,264 @@
+import os
 import sys
 import socket
-import select
+import signal
+import time
 import threading
+import selectors
 import argparse
-from usbmux import USBMux, MuxDevice
+import concurrent.futures
+from queue import SimpleQueue
+from usbmux import USBMux, MuxDevice, SOCKBUF
+
+BUFSIZE = 65536
+HAVE_SPLICE = hasattr(os, 'splice')
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+# 进程启动时允许使用的 CPU；accept 线程会被绑核，由它创建的线程池线程需恢复
+_CPUS = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+
+
+def _unpin():
+    if _CPUS is not None:
+        os.sched_setaffinity(0, _CPUS)
+
+
+# 所有 relay 共用的连接建立线程池，转发本身在 Forwarder 的事件循环中完成
+_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("USBMUX_RELAY_THREADS", (os.cpu_count() or 1) * 2)),
+    initializer=_unpin)
+
+# 只有 Linux 的 SO_REUSEPORT 会在多个监听 socket 之间做负载均衡
+HAVE_REUSEPORT = sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def _tune(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKBUF)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKBUF)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class _Endpoint:
+    def __init__(self, sock):
+        self.sock = sock
+        self.peer = None
+        self.events = 0
+        self.pending = b''  # 等待写入 sock 的数据
+        self.cork = False  # 源端可能还有数据时提示内核合并发送
+        self.more = False
+
+    def fill(self, src):
+        self.pending = memoryview(src.recv(BUFSIZE))
+        self.more = self.cork and len(self.pending) == BUFSIZE
+        return len(self.pending)
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.pending, MSG_MORE if self.more else 0)
+        except BlockingIOError:
+            return
+        self.pending = self.pending[sent:]
+
+    def close(self):
+        self.sock.close()
+
+
+class _SpliceEndpoint(_Endpoint):
+    # 数据经由管道在内核中搬运，不经过用户态
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.pending = 0
+        self.pipe_r, self.pipe_w = os.pipe()
+
+    def fill(self, src):
+        self.pending = os.splice(src.fileno(), self.pipe_w, BUFSIZE,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.more = self.cork and self.pending == BUFSIZE
+        return self.pending
+
+    def flush(self):
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        if self.more:
+            flags |= os.SPLICE_F_MORE
+        try:
+            sent = os.splice(self.pipe_r, self.sock.fileno(), self.pending, flags=flags)
+        except BlockingIOError:
+            return
+        self.pending -= sent
+
+    def close(self):
+        super().close()
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class Forwarder:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.queue = SimpleQueue()
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, selectors.EVENT_READ)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, a, b):
+        self.queue.put((a, b))
+        try:
+            self.waker_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _update(self, ep):
+        events = 0
+        if not ep.peer.pending:
+            events |= selectors.EVENT_READ
+        if ep.pending:
+            events |= selectors.EVENT_WRITE
+        if events == ep.events:
+            return
+        if not ep.events:
+            self.selector.register(ep.sock, events, ep)
+        elif not events:
+            self.selector.unregister(ep.sock)
+        else:
+            self.selector.modify(ep.sock, events, ep)
+        ep.events = events
+
+    def _attach(self, a, b):
+        endpoint = _SpliceEndpoint if HAVE_SPLICE else _Endpoint
+        created = []
+        try:
+            a.setblocking(False)
+            b.setblocking(False)
+            for sock in (a, b):
+                created.append(endpoint(sock))
+            ea, eb = created
+            ea.cork = True  # 设备 -> 客户端方向
+            ea.peer, eb.peer = eb, ea
+            self._update(ea)
+            self._update(eb)
+        except OSError:
+            # 释放已创建的管道和已注册的 socket，避免在 fd 紧张时泄漏
+            for e in created:
+                if e.events:
+                    self.selector.unregister(e.sock)
+                    e.events = 0
+                e.close()
+            raise
+
+    def _close(self, ep):
+        for e in (ep, ep.peer):
+            if e.events:
+                self.selector.unregister(e.sock)
+                e.events = 0
+            e.close()
+
+    def _wake(self):
+        try:
+            while self.waker_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.queue.empty():
+            a, b = self.queue.get()
+            try:
+                self._attach(a, b)
+            except OSError as e:
+                print(f"[-] Could not forward connection: {e}")
+                a.close()
+                b.close()
+
+    def run(self):
+        while True:
+            for key, mask in self.selector.select():
+                ep = key.data
+                if ep is None:
+                    self._wake()
+                    continue
+                if not ep.events:
+                    continue  # 同一轮中已被关闭
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        ep.flush()
+                    if mask & selectors.EVENT_READ and not ep.peer.pending:
+                        if not ep.peer.fill(ep.sock):
+                            raise EOFError
+                        ep.peer.flush()
+                except BlockingIOError:
+                    pass
+                except Exception:
+                    self._close(ep)
+                    continue
+                self._update(ep)
+                self._update(ep.peer)
 
 class TCPRelay:
-    def __init__(self, remote_port, local_port, device: MuxDevice):
+    def __init__(self, remote_port, local_port, device: MuxDevice, executor=None, listeners=None, mux=None):
         self.local_port = local_port
         self.remote_port = remote_port
         self.device = device
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind(('localhost', self.local_port))
-        self.server.listen(5)
+        self.mux = mux or USBMux()
+        self.executor = executor or _POOL
+        self.forwarder = Forwarder()
+        if not HAVE_REUSEPORT:
+            listeners = 1
+        elif listeners is None:
+            listeners = os.cpu_count() or 1
+        reuseport = listeners > 1
+        if reuseport:
+            # 带 SO_REUSEPORT 的重复绑定会静默成功，先做一次独占绑定确认端口未被占用
+            probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                probe.bind(('localhost', self.local_port))
+                self.local_port = probe.getsockname()[1]
+            finally:
+                probe.close()
+        self.servers = []
+        for i in range(listeners):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuseport:
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server.bind(('localhost', self.local_port))
+            self.local_port = server.getsockname()[1]  # local_port 为 0 时其余 socket 绑定到同一端口
+            _tune(server)
+            server.listen(socket.SOMAXCONN)
+            self.servers.append(server)
+        self.server = self.servers[0]
         print(f"[+] Listening on localhost:{self.local_port}, forwarding to device port {self.remote_port}")
 
     def handle_connection(self, client_sock):
         try:
-            mux = USBMux()
-            if not mux.devices:
-                mux.process(1.0)  # 等待设备
-            device = mux.devices[0]
-            device_sock = mux.connect(device, self.remote_port)  # 连接设备目标端口
-            # device_sock = self.device.connect_tcp(self.remote_port)
+            _tune(client_sock)
+            device_sock = self.mux.connect(self.device, self.remote_port)  # 连接设备目标端口
         except Exception as e:
             print(f"[-] Could not connect to device port {self.remote_port}: {e}")
             client_sock.close()
             return
 
-        def forward(src, dst):
-            try:
-                while True:
-                    data = src.recv(4096)
-                    if not data:
-                        break
-                    dst.sendall(data)
-            except Exception:
-                pass
-            finally:
-                src.close()
-                dst.close()
+        self.forwarder.add(client_sock, device_sock)
 
-        threading.Thread(target=forward, args=(client_sock, device_sock)).start()
-        threading.Thread(target=forward, args=(device_sock, client_sock)).start()
-
-    def serve_forever(self):
-        try:
-            while True:
-                client_sock, _ = self.server.accept()
-                threading.Thread(target=self.handle_connection, args=(client_sock,)).start()
-        except KeyboardInterrupt:
-            print("\n[!] Shutting down server")
-            self.server.close()
+    def serve_forever(self, server=None, cpu=None):
+        if server is None:
+            # 未指定监听 socket 时负责全部监听 socket，避免分到其余队列的连接无人 accept
+            for other in self.servers[1:]:
+                threading.Thread(target=self.serve_forever, args=(other,), daemon=True).start()
+            server = self.server
+        if cpu is not None and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[cpu % len(cpus)]})
+        while True:
+            try:
+                client_sock, _ = server.accept()
+            except OSError as e:
+                # 如 fd 耗尽 (EMFILE)，稍后重试，不能让监听 socket 无人 accept
+                print(f"[-] Could not accept connection: {e}")
+                time.sleep(0.1)
+                continue
+            self.executor.submit(self.handle_connection, client_sock)
 
 
 def parse_ports(ports):
@@ -83,16 +289,25 @@ def main():
     print(f"[+] Using device: UDID={device.devid} Serial={device.serial}")
 
     port_pairs = parse_ports(args.ports)
-    relays = [TCPRelay(local, remote, device) for local, remote in port_pairs]
+    relays = [TCPRelay(local, remote, device, mux=mux) for local, remote in port_pairs]
 
     for relay in relays:
-        threading.Thread(target=relay.serve_forever, daemon=True).start()
+        for i, server in enumerate(relay.servers):
+            threading.Thread(target=relay.serve_forever, args=(server, i), daemon=True).start()
 
+    # 由默认的 SIGINT 处理抛出 KeyboardInterrupt，信号处理中不持有任何锁
+    signal.signal(signal.SIGINT, signal.default_int_handler)
     try:
-        while True:
-            threading.Event().wait(1)
+        if hasattr(signal, 'pause'):
+            while True:
+                signal.pause()
+        else:
+            # Windows 没有 signal.pause，time.sleep 可被 Ctrl-C 打断
+            while True:
+                time.sleep(1)
     except KeyboardInterrupt:
-        print("\n[!] Exiting")
+        pass
+    print("\n[!] Exiting")
 
 
 if __name__ == '__main__':
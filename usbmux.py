@@ -1,6 +1,7 @@
+import errno
 import socket
 import struct
-import select
+import selectors
 import sys
 
 try:
@@ -9,6 +10,17 @@ try:
 except ImportError:
     haveplist = False
 
+# Linux 会把 SO_SNDBUF/SO_RCVBUF 的设置值翻倍，这里只请求一半
+SOCKBUF = (1 << 19) if sys.platform.startswith('linux') else (1 << 20)
+_IS_WIN = sys.platform in ('win32', 'cygwin')
+SEQPACKET_SIZE = 65536
+
+# usbmuxd 是否接受 SOCK_SEQPACKET 连接，None 表示尚未探测
+_seqpacket_ok = None if hasattr(socket, 'SOCK_SEQPACKET') else False
+# 只有这些错误说明 usbmuxd/系统不支持 SOCK_SEQPACKET，其余错误（如守护进程未启动）不缓存
+_SEQPACKET_UNSUPPORTED = {errno.EPROTOTYPE, errno.EPROTONOSUPPORT,
+                          getattr(errno, 'ESOCKTNOSUPPORT', errno.EPROTONOSUPPORT)}
+
 class MuxError(Exception):
     pass
 
@@ -16,28 +28,82 @@ class MuxVersionError(MuxError):
     pass
 
 class SafeStreamSocket:
-    def __init__(self, address, family):
-        self.sock = socket.socket(family, socket.SOCK_STREAM)
-        self.sock.connect(address)
+    __slots__ = ('sock', 'seqpacket')
+
+    def __init__(self, address, family, seqpacket=False):
+        global _seqpacket_ok
+        self.seqpacket = seqpacket and family == socket.AF_UNIX and _seqpacket_ok is not False
+        if self.seqpacket:
+            try:
+                self.sock = socket.socket(family, socket.SOCK_SEQPACKET)
+            except OSError as e:
+                self.seqpacket = False
+                if e.errno in _SEQPACKET_UNSUPPORTED:
+                    _seqpacket_ok = False
+            else:
+                try:
+                    self.sock.connect(address)
+                    _seqpacket_ok = True
+                except OSError as e:
+                    self.sock.close()
+                    self.seqpacket = False
+                    if e.errno in _SEQPACKET_UNSUPPORTED:
+                        _seqpacket_ok = False
+        if not self.seqpacket:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKBUF)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKBUF)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def send(self, msg):
+        view = memoryview(msg)
         totalsent = 0
-        while totalsent < len(msg):
-            sent = self.sock.send(msg[totalsent:])
+        while totalsent < len(view):
+            sent = self.sock.send(view[totalsent:])
             if sent == 0:
                 raise MuxError("socket connection broken")
             totalsent += sent
 
-    def recv(self, size):
-        msg = b''
-        while len(msg) < size:
-            chunk = self.sock.recv(size - len(msg))
-            if chunk == b'':
+    def sendmsg(self, buffers):
+        if not hasattr(self.sock, 'sendmsg'):
+            return self.send(b''.join(buffers))
+        views = [memoryview(buf) for buf in buffers if len(buf)]
+        while views:
+            sent = self.sock.sendmsg(views)
+            if sent == 0:
                 raise MuxError("socket connection broken")
-            msg += chunk
+            # 跳过已完整发送的缓冲区，截掉部分发送的那一个
+            while sent >= len(views[0]):
+                sent -= len(views.pop(0))
+                if not views:
+                    return
+            views[0] = views[0][sent:]
+
+    def recv_into(self, buf):
+        view = memoryview(buf)
+        got = 0
+        while got < len(view):
+            n = self.sock.recv_into(view[got:])
+            if n == 0:
+                raise MuxError("socket connection broken")
+            got += n
+
+    def recv(self, size):
+        buf = bytearray(size)
+        self.recv_into(buf)
+        return buf
+
+    def recvpacket(self):
+        msg = self.sock.recv(SEQPACKET_SIZE)
+        if not msg:
+            raise MuxError("socket connection broken")
         return msg
 
 class MuxDevice:
+    __slots__ = ('devid', 'usbprod', 'serial', 'location')
+
     def __init__(self, devid, usbprod, serial, location):
         self.devid = devid
         self.usbprod = usbprod
@@ -54,6 +120,15 @@ class BinaryProtocol:
     TYPE_DEVICE_ADD = 4
     TYPE_DEVICE_REMOVE = 5
     VERSION = 0
+    __slots__ = ('socket', 'connected')
+
+    _LEN = struct.Struct("I")
+    _HDR = struct.Struct("IIII")
+    _CONNECT = struct.Struct("IH")
+    _RESULT = struct.Struct("I")
+    _RESP_HDR = struct.Struct("III")
+    _DEVADD = struct.Struct("IH256sHI")
+    _DEVREMOVE = struct.Struct("I")
 
     def __init__(self, socket):
         self.socket = socket
@@ -61,7 +136,7 @@ class BinaryProtocol:
 
     def _pack(self, req, payload):
         if req == self.TYPE_CONNECT:
-            return struct.pack("IH", payload['DeviceID'], payload['PortNumber']) + b"\x00\x00"
+            return self._CONNECT.pack(payload['DeviceID'], payload['PortNumber']) + b"\x00\x00"
         elif req == self.TYPE_LISTEN:
             return b""
         else:
@@ -69,13 +144,14 @@ class BinaryProtocol:
 
     def _unpack(self, resp, payload):
         if resp == self.TYPE_RESULT:
-            return {'Number': struct.unpack("I", payload)[0]}
+            return {'Number': self._RESULT.unpack_from(payload)[0]}
         elif resp == self.TYPE_DEVICE_ADD:
-            devid, usbpid, serial, pad, location = struct.unpack("IH256sHI", payload)
-            serial = serial.split(b"\0")[0].decode()
+            devid, usbpid, serial, pad, location = self._DEVADD.unpack_from(payload)
+            nul = serial.find(b"\0")
+            serial = serial[:nul if nul >= 0 else len(serial)].decode()
             return {'DeviceID': devid, 'Properties': {'LocationID': location, 'SerialNumber': serial, 'ProductID': usbpid}}
         elif resp == self.TYPE_DEVICE_REMOVE:
-            devid = struct.unpack("I", payload)[0]
+            devid = self._DEVREMOVE.unpack_from(payload)[0]
             return {'DeviceID': devid}
         else:
             raise MuxError(f"Invalid incoming request type {resp}")
@@ -85,19 +161,29 @@ class BinaryProtocol:
         if self.connected:
             raise MuxError("Mux is connected, cannot issue control packets")
         length = 16 + len(payload_bytes)
-        data = struct.pack("IIII", length, self.VERSION, req, tag) + payload_bytes
-        self.socket.send(data)
+        header = self._HDR.pack(length, self.VERSION, req, tag)
+        self.socket.sendmsg([header, payload_bytes])
 
     def getpacket(self):
         if self.connected:
             raise MuxError("Mux is connected, cannot issue control packets")
-        dlen = self.socket.recv(4)
-        dlen = struct.unpack("I", dlen)[0]
-        body = self.socket.recv(dlen - 4)
-        version, resp, tag = struct.unpack("III", body[:12])
+        if self.socket.seqpacket:
+            # 内核保留消息边界，一次 recv 即可读到整个包
+            msg = self.socket.recvpacket()
+            if len(msg) < self._LEN.size:
+                raise MuxError(f"Short packet: got {len(msg)} bytes")
+            dlen = self._LEN.unpack_from(msg, 0)[0]
+            if len(msg) != dlen:
+                raise MuxError(f"Packet length mismatch: header says {dlen}, got {len(msg)}")
+            body = memoryview(msg)[4:]
+        else:
+            dlen = self.socket.recv(4)
+            dlen = self._LEN.unpack(dlen)[0]
+            body = self.socket.recv(dlen - 4)
+        version, resp, tag = self._RESP_HDR.unpack_from(body, 0)
         if version != self.VERSION:
             raise MuxVersionError(f"Version mismatch: expected {self.VERSION}, got {version}")
-        payload = self._unpack(resp, body[12:])
+        payload = self._unpack(resp, memoryview(body)[12:])
         return resp, tag, payload
 
 class PlistProtocol(BinaryProtocol):
@@ -108,6 +194,10 @@ class PlistProtocol(BinaryProtocol):
     TYPE_DEVICE_REMOVE = "Detached"
     TYPE_PLIST = 8
     VERSION = 1
+    __slots__ = ()
+
+    PLIST_FMT = plistlib.FMT_BINARY if haveplist else None
+    CLIENT_INFO = {'ClientVersionString': 'usbmux.py by marcan', 'ProgName': 'tcprelay'}
 
     def __init__(self, socket):
         if not haveplist:
@@ -121,12 +211,11 @@ class PlistProtocol(BinaryProtocol):
         return payload
 
     def sendpacket(self, req, tag, payload={}):
-        payload['ClientVersionString'] = 'usbmux.py by marcan'
         if isinstance(req, int):
             req = [self.TYPE_CONNECT, self.TYPE_LISTEN][req - 2]
-        payload['MessageType'] = req
-        payload['ProgName'] = 'tcprelay'
-        plist_data = plistlib.dumps(payload)
+        packet = dict(payload, MessageType=req)
+        packet.update(self.CLIENT_INFO)
+        plist_data = plistlib.dumps(packet, fmt=self.PLIST_FMT)
         super().sendpacket(self.TYPE_PLIST, tag, plist_data)
 
     def getpacket(self):
@@ -136,19 +225,28 @@ class PlistProtocol(BinaryProtocol):
         payload = plistlib.loads(payload)
         return payload['MessageType'], tag, payload
 
+class XmlPlistProtocol(PlistProtocol):
+    # 部分 usbmuxd 只能解析 XML 格式的 plist
+    __slots__ = ()
+    PLIST_FMT = plistlib.FMT_XML if haveplist else None
+
 class MuxConnection:
-    def __init__(self, socketpath, protoclass):
+    __slots__ = ('socketpath', 'socket', 'proto', 'pkttag', 'devices', '_by_devid', '_sel')
+
+    def __init__(self, socketpath, protoclass, seqpacket=False):
         self.socketpath = socketpath
-        if sys.platform in ['win32', 'cygwin']:
+        if _IS_WIN:
             family = socket.AF_INET
             address = ('127.0.0.1', 27015)
         else:
             family = socket.AF_UNIX
             address = self.socketpath
-        self.socket = SafeStreamSocket(address, family)
+        self.socket = SafeStreamSocket(address, family, seqpacket)
         self.proto = protoclass(self.socket)
         self.pkttag = 1
         self.devices = []
+        self._by_devid = {}
+        self._sel = None
 
     def _getreply(self):
         while True:
@@ -161,16 +259,24 @@ class MuxConnection:
     def _processpacket(self):
         resp, tag, data = self.proto.getpacket()
         if resp == self.proto.TYPE_DEVICE_ADD:
-            self.devices.append(MuxDevice(data['DeviceID'], data['Properties']['ProductID'], data['Properties']['SerialNumber'], data['Properties']['LocationID']))
+            dev = MuxDevice(data['DeviceID'], data['Properties']['ProductID'], data['Properties']['SerialNumber'], data['Properties']['LocationID'])
+            old = self._by_devid.pop(dev.devid, None)
+            if old is not None:
+                self.devices.remove(old)
+            self._by_devid[dev.devid] = dev
+            self.devices.append(dev)
         elif resp == self.proto.TYPE_DEVICE_REMOVE:
-            for dev in self.devices:
-                if dev.devid == data['DeviceID']:
-                    self.devices.remove(dev)
+            dev = self._by_devid.pop(data['DeviceID'], None)
+            if dev is not None:
+                self.devices.remove(dev)
         elif resp == self.proto.TYPE_RESULT:
             raise MuxError(f"Unexpected result: {resp}")
         else:
             raise MuxError(f"Invalid packet type received: {resp}")
 
+    def find_by_devid(self, devid):
+        return self._by_devid.get(devid)
+
     def _exchange(self, req, payload={}):
         mytag = self.pkttag
         self.pkttag += 1
@@ -188,16 +294,18 @@ class MuxConnection:
     def process(self, timeout=None):
         if self.proto.connected:
             raise MuxError("Socket is connected, cannot process listener events")
-        rlo, wlo, xlo = select.select([self.socket.sock], [], [self.socket.sock], timeout)
-        if xlo:
-            self.socket.sock.close()
-            raise MuxError("Exception in listener socket")
-        if rlo:
+        if self._sel is None:
+            self._sel = selectors.DefaultSelector()
+            self._sel.register(self.socket.sock, selectors.EVENT_READ)
+        # 一次唤醒后处理完所有已到达的包
+        events = self._sel.select(timeout)
+        while events:
             self._processpacket()
+            events = self._sel.select(0)
 
     def connect(self, device, port):
-        # 端口大小端转换
-        port_swapped = ((port << 8) & 0xFF00) | (port >> 8)
+        # 端口转为网络字节序
+        port_swapped = socket.htons(port)
         ret = self._exchange(self.proto.TYPE_CONNECT, {'DeviceID': device.devid, 'PortNumber': port_swapped})
         if ret != 0:
             raise MuxError(f"Connect failed: error {ret}")
@@ -205,6 +313,8 @@ class MuxConnection:
         return self.socket.sock
 
     def close(self):
+        if self._sel is not None:
+            self._sel.close()
         self.socket.sock.close()
 
 class USBMux:
@@ -215,21 +325,31 @@ class USBMux:
             else:
                 socketpath = "/var/run/usbmuxd"
         self.socketpath = socketpath
-        self.listener = MuxConnection(socketpath, BinaryProtocol)
+        self.listener = MuxConnection(socketpath, BinaryProtocol, seqpacket=True)
         try:
             self.listener.listen()
             self.version = 0
             self.protoclass = BinaryProtocol
         except MuxVersionError:
-            self.listener = MuxConnection(socketpath, PlistProtocol)
-            self.listener.listen()
-            self.protoclass = PlistProtocol
+            self.listener.close()
+            self.listener = MuxConnection(socketpath, PlistProtocol, seqpacket=True)
+            try:
+                self.listener.listen()
+                self.protoclass = PlistProtocol
+            except (MuxError, OSError):
+                self.listener.close()
+                self.listener = MuxConnection(socketpath, XmlPlistProtocol, seqpacket=True)
+                self.listener.listen()
+                self.protoclass = XmlPlistProtocol
             self.version = 1
         self.devices = self.listener.devices
 
     def process(self, timeout=None):
         self.listener.process(timeout)
 
+    def find_by_devid(self, devid):
+        return self.listener.find_by_devid(devid)
+
     def connect(self, device, port):
         connector = MuxConnection(self.socketpath, self.protoclass)
         return connector.connect(device, port)